@@ -1,10 +1,12 @@
 import aiohttp
+from aiohttp import web
 import asyncio
 import argparse
+import inspect
 from copy import deepcopy
 import os
 import sys
-from typing import Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
 from PySide2.QtWidgets import QApplication, QWidget, QLineEdit, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QFormLayout, QProgressBar, QMessageBox, QTextEdit, QCheckBox
 from PySide2.QtGui import QFont
@@ -17,6 +19,12 @@ from bilibili_api import video, Credential, HEADERS, settings
 PIECE = 1 * 1024  # 分片下载的大小的初始值，程序会根据实际情况自动进行动态调整。但初始值对最终的平均下载速度有影响，但也并不是越大越好，初始值太大会导致多次重传，而这会极大地拖慢速度，要实际情况调整，根据我的经验一般8*1024最好，下载效果不好就再缩小一点
 SUCCESS_REPEAT = 0  # 仅当重复成功时才允许加快下载速度，而且保险起见必须一次过
 
+# 边下边播用的参数
+SEGMENT = 256 << 10  # 边下边播时的分段大小，固定不变，这样才好按播放位置调度下载顺序
+STREAM_WORKERS = 4  # 边下边播时每路媒体（视频/音频）同时下载的分段数
+SEGMENT_RETRY = 3  # 一个分段（包括切成小块重下）都失败后，放回队列重新下载的最多次数
+SHUTDOWN_TIMEOUT = 1.0  # 关闭播放服务时最多等还在发数据的请求多少秒，播放器暂停时写入会一直卡着，不能等默认的60秒
+
 
 def speed_up():
     """加速并将累计连续成功次数清零，加速上限256K"""
@@ -252,6 +260,84 @@ class Data:
         return f'./{self.get_save_dir()}/cover.jpg'
 
 
+class StreamFile:
+    """
+    边下边播用的临时文件：按SEGMENT大小分段，记录每段是否已下载完成，
+    并优先调度播放器当前所读位置（playhead）往后的分段
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.length = 0
+        self.done = 0  # 已下载的字节数
+        self.playhead = 0  # 播放器最近读取的段号
+        self.error: Optional[Exception] = None
+        self.ready = asyncio.Event()  # 总长度已知且文件已预分配后才能读
+        self._events: List[asyncio.Event] = []
+        self._pending: Set[int] = set()  # 还没被任何worker领走的段号
+        self._done: Set[int] = set()
+        self._failures: Dict[int, int] = {}  # 每个分段已经失败的次数
+
+    def init(self, length: int, first: bytes):
+        """拿到总长度后预分配文件，并写入已经下载好的第0段"""
+        self.length = length
+        segments = (length + SEGMENT - 1) // SEGMENT
+        self._events = [asyncio.Event() for _ in range(segments)]
+        self._pending = set(range(1, segments))
+        with open(self.path, 'wb') as file:
+            file.truncate(length)
+        self.write(0, first)
+        self.ready.set()
+
+    def segment_range(self, index: int) -> Tuple[int, int]:
+        """返回第index段的 (start, end)，两端都包含，和Range头的写法一致"""
+        start = index * SEGMENT
+        return start, min(start + SEGMENT, self.length) - 1
+
+    def claim(self) -> Optional[int]:
+        """领取下一个要下载的段号，全部领完则返回None"""
+        if not self._pending:
+            return None
+        ahead = [i for i in self._pending if i >= self.playhead]
+        index = min(ahead) if ahead else min(self._pending)  # 播放位置往后的都下完了再回头补前面的
+        self._pending.remove(index)
+        return index
+
+    def release(self, index: int) -> bool:
+        """分段下载失败时放回队列稍后重下，失败次数超过SEGMENT_RETRY则返回False"""
+        self._failures[index] = self._failures.get(index, 0) + 1
+        if self._failures[index] > SEGMENT_RETRY:
+            return False
+        self._pending.add(index)
+        return True
+
+    def write(self, index: int, bs: bytes):
+        with open(self.path, 'r+b') as file:
+            file.seek(index * SEGMENT)
+            file.write(bs)
+        self.done += len(bs)
+        self._done.add(index)
+        self._events[index].set()
+
+    def fail(self, e: Exception):
+        """下载失败时唤醒所有还在等数据的请求，免得播放器一直卡着"""
+        self.error = e
+        self.ready.set()
+        for event in self._events:
+            event.set()
+
+    async def read(self, pos: int, stop: int) -> bytes:
+        """读取 [pos, stop) 中和pos同一段的那部分，该段还没下载完就等它下完"""
+        index = pos // SEGMENT
+        self.playhead = index
+        await self._events[index].wait()
+        if index not in self._done:
+            raise RuntimeError(f'下载失败：{self.error!r}')
+        with open(self.path, 'rb') as file:
+            file.seek(pos)
+            return file.read(min(stop, (index + 1) * SEGMENT) - pos)
+
+
 class GetInfoThread(QThread):
     info_got = Signal(dict)
     error_msg = Signal(str)
@@ -283,10 +369,17 @@ class DownloadThread(QThread):
     audio_done = Signal(int)
     audio_all = Signal(int)
     error_msg = Signal(str)
+    msg = Signal(str)
 
     def __init__(self) -> None:
         super().__init__()
         self.video: video.Video = None
+        self.stream = False  # 是否边下边播
+        self.streams: Dict[str, StreamFile] = {}
+        self.serving = False  # 下载已完成，只剩播放服务还开着
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
 
     @retry(5)
     async def download_piece(self, sess: aiohttp.ClientSession, url: str, start: int, end: int) -> Tuple[bytes, int]:
@@ -297,7 +390,13 @@ class DownloadThread(QThread):
         headers['range'] = f'bytes={start}-{end}'
         async with sess.get(url, headers=headers, proxy=args.proxy) as resp:
             bs = await resp.content.read()  # 就是要存内存里，直接写文件就不方便断点续传了
-            return bs, int(resp.headers['Content-Range'].split('/')[-1])
+            content_range = resp.headers['Content-Range']  # bytes {first}-{last}/{length}
+            first, last = map(int, content_range.split(' ')[-1].split('/')[0].split('-'))
+            length = int(content_range.split('/')[-1])
+            # 返回的范围或数据长度不对就当失败重试，否则会把错位的数据写进文件里
+            if first != start or last != min(end, length - 1) or len(bs) != last - first + 1:
+                raise RuntimeError(f'分段数据不完整：请求 {start}-{end}，返回 {content_range}，实际 {len(bs)} 字节')
+            return bs, length
 
     async def download_media(self, sess: aiohttp.ClientSession, url: str, mode: str):
         """
@@ -326,35 +425,193 @@ class DownloadThread(QThread):
                 if end > length - 1:
                     end = length - 1
 
+    async def download_segment(self, sess: aiohttp.ClientSession, url: str, start: int, end: int) -> Tuple[bytes, int]:
+        """
+        下载边下边播的一个分段并返回 (bytes, total_length)。
+        整段下载失败时按PIECE切成小块再下，和普通模式一样随网速自动调整块大小
+        """
+        try:
+            return await self.download_piece(sess, url, start, end)
+        except RuntimeError:
+            pass
+        pieces, pos = [], start
+        while pos <= end:
+            bs, length = await self.download_piece(sess, url, pos, min(pos + PIECE - 1, end))
+            end = min(end, length - 1)
+            pieces.append(bs)
+            pos += len(bs)
+        return b''.join(pieces), length
+
+    async def download_media_stream(self, sess: aiohttp.ClientSession, url: str, mode: str):
+        """
+        边下边播模式下的下载：固定大小分段，多个worker并发下载，优先下载播放位置附近的分段
+        :param mode: enum('video', 'audio')
+        """
+        all_signal = self.video_all if mode == 'video' else self.audio_all
+        done_signal = self.video_done if mode == 'video' else self.audio_done
+        stream = self.streams[mode]
+
+        async def worker():
+            while (index := stream.claim()) is not None:
+                start, end = stream.segment_range(index)
+                try:
+                    bs, _ = await self.download_segment(sess, url, start, end)
+                except RuntimeError:
+                    if not stream.release(index):
+                        raise
+                    self.msg.emit(f'{mode} 第 {index} 段下载失败，稍后重试')
+                    continue
+                stream.write(index, bs)
+                done_signal.emit(stream.done)
+
+        done_signal.emit(0)
+        workers = []
+        try:
+            bs, length = await self.download_segment(sess, url, 0, SEGMENT - 1)
+            all_signal.emit(length)
+            stream.init(length, bs)
+            done_signal.emit(stream.done)
+            workers = [asyncio.create_task(worker()) for _ in range(STREAM_WORKERS)]
+            await asyncio.gather(*workers)
+        except Exception as e:
+            for task in workers:  # 有分段重试多次都失败，整个就失败了，其他worker没必要再下了
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            stream.fail(e)
+            self.msg.emit(f'{mode} 下载失败：{e!r}')
+            raise
+
+    async def serve_media(self, request: web.Request) -> web.StreamResponse:
+        """把下载中的临时文件按Range提供给播放器，还没下载到的部分会等下载完再发"""
+        mode = request.match_info['mode']
+        stream = self.streams[mode]
+        await stream.ready.wait()
+        if stream.error is not None:
+            raise web.HTTPServiceUnavailable(text=repr(stream.error))
+        partial = 'Range' in request.headers
+        try:
+            start, stop, _ = request.http_range.indices(stream.length)
+        except ValueError:  # 多段Range之类处理不了的，按HTTP规范可以忽略Range，直接发整个文件
+            partial, start, stop = False, 0, stream.length
+        if start >= stop:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{stream.length}'})
+
+        resp = web.StreamResponse(status=206 if partial else 200)
+        resp.content_type = f'{mode}/mp4'
+        resp.content_length = stop - start
+        resp.headers['Accept-Ranges'] = 'bytes'
+        if partial:
+            resp.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{stream.length}'
+        await resp.prepare(request)
+        if request.method == 'HEAD':
+            return resp
+
+        pos = start
+        while pos < stop:
+            try:
+                data = await stream.read(pos, stop)
+            except RuntimeError:  # 下载失败或中止了，响应头已经发出去，只能直接断开
+                resp.force_close()
+                return resp
+            await resp.write(data)
+            pos += len(data)
+        return resp
+
+    async def start_server(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_get('/{mode:video|audio}', self.serve_media)
+        # aiohttp 3.9起shutdown_timeout从TCPSite挪到了AppRunner上
+        if 'shutdown_timeout' in inspect.signature(web.BaseRunner).parameters:
+            runner = web.AppRunner(app, access_log=None, shutdown_timeout=SHUTDOWN_TIMEOUT)
+            site_kwargs = {}
+        else:
+            runner = web.AppRunner(app, access_log=None)
+            site_kwargs = {'shutdown_timeout': SHUTDOWN_TIMEOUT}
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, '127.0.0.1', args.port, **site_kwargs).start()
+        except Exception:
+            await runner.cleanup()
+            raise
+        base = f'http://127.0.0.1:{args.port}'
+        self.msg.emit(f'边下边播已开启，视频：{base}/video ，音频：{base}/audio')
+        self.msg.emit(f'例如：mpv {base}/video --audio-file={base}/audio')
+        return runner
+
     async def download(self):
+        if self._stopping:  # 还没开始就被中止了
+            return
+        runner = None
+        self.streams = {}
         try:
             url = await self.video.get_download_url(window.data.pid)
             async with aiohttp.ClientSession() as sess:
+                if self.stream:
+                    self.streams = {mode: StreamFile(f'{mode}_temp.m4s') for mode in ['video', 'audio']}
+                    runner = await self.start_server()
                 # create tasks
                 download_tasks = []  # 不敢在分片的地方异步，但音视频相对独立，就没问题了
                 for mode in ['video', 'audio']:  # 音视频下载的代码长得差不多还重写两遍也太浪费了
                     if os.path.exists(f'{mode}_temp.m4s'):
                         os.remove(f"{mode}_temp.m4s")
                     download_url = url["dash"][mode][0]['baseUrl']
+                    download_media = self.download_media_stream if self.stream else self.download_media
                     download_tasks.append(
-                        asyncio.create_task(self.download_media(sess, download_url, mode))
+                        asyncio.create_task(download_media(sess, download_url, mode))
                     )
                 # download video&audio asynchronously
-                await asyncio.wait(download_tasks)
+                try:
+                    await asyncio.wait(download_tasks, return_when=asyncio.FIRST_EXCEPTION)  # 一路失败另一路就不用下了
+                finally:  # 被中止时要在关掉session之前把下载任务收拾干净
+                    for task in download_tasks:
+                        task.cancel()
+                    await asyncio.gather(*download_tasks, return_exceptions=True)
+                for task in download_tasks:
+                    if not task.cancelled() and task.exception() is not None:
+                        raise task.exception()
+            self.serving = runner is not None  # 要在downloaded之前设好，GUI收到downloaded就可能开始下一次下载
             self.downloaded.emit()
+            if runner is not None:  # 下载完了播放器可能还在看，播放服务一直开着，直到下次下载或关闭窗口
+                self.msg.emit('下载完成，播放服务会一直运行到下次下载或关闭窗口')
+                await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
             self.error_msg.emit(repr(e))
         finally:  # 不管下载成功失败，这个调整下载速度的系统都要重置一下
             global PIECE, SUCCESS_REPEAT
             PIECE = 8 * 1024
             SUCCESS_REPEAT = 0
+            for stream in self.streams.values():  # 唤醒还在等数据的请求，不然关闭服务时要等它们超时
+                stream.fail(RuntimeError('下载已中止'))
+            if runner is not None:
+                await runner.cleanup()
+
+    def start(self):
+        self.serving = False
+        self._task = None
+        self._stopping = False
+        super().start()
+
+    def stop(self):
+        """中止下载并关闭边下边播的播放服务，可以在其他线程里调用"""
+        if self._stopping:  # 只中止一次，再取消就会打断finally里的清理
+            return
+        self._stopping = True  # download()还没开始的话，由它自己检查这个标志
+        if self.isRunning() and self._loop is not None and self._task is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
 
     def run(self) -> None:
         try:
             asyncio.get_event_loop()
         except RuntimeError:
             asyncio.set_event_loop(asyncio.new_event_loop())
-        asyncio.get_event_loop().run_until_complete(self.download())
+        self._loop = asyncio.get_event_loop()
+        self._task = self._loop.create_task(self.download())
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:  # 任务还没开始运行就被stop()取消了
+            pass
 
 
 class MixThread(QThread):
@@ -483,6 +740,8 @@ class Window(QWidget):
         self.download_btn = QPushButton()
         self.download_btn.setEnabled(False)
         self.download_btn.clicked.connect(self.download_btn_handler)
+        self.stream_check = QCheckBox('边下边播')
+        self.stream_check.setToolTip(f'下载的同时在 http://127.0.0.1:{args.port} 提供播放，可以用mpv等播放器边下边看')
         self.video_bar = QProgressBar()
         self.audio_bar = QProgressBar()
         self.mix_btn = QPushButton('混流')
@@ -511,11 +770,14 @@ class Window(QWidget):
         self.get_info_thread.error_msg.connect(lambda msg: QMessageBox.warning(self, '获取信息失败！', msg))
         self.download_thread = DownloadThread()
         self.download_thread.downloaded.connect(self.downloaded_handler)
+        self.download_thread.finished.connect(self.download_finished_handler)
+        self.pending_download = False  # 等上次的播放服务关掉后再开始下载
         self.download_thread.video_done.connect(self.set_video_done)
         self.download_thread.video_all.connect(self.set_video_all)
         self.download_thread.audio_done.connect(self.set_audio_done)
         self.download_thread.audio_all.connect(self.set_audio_all)
         self.download_thread.error_msg.connect(lambda msg: QMessageBox.warning(self, '下载失败！', msg))
+        self.download_thread.msg.connect(lambda msg: self.log_text.append(msg))
         self.mix_thread = MixThread()
         self.mix_thread.msg.connect(lambda msg: self.log_text.append(msg))
         self.mix_thread.end.connect(lambda: self.mix_btn.setEnabled(True))
@@ -527,7 +789,7 @@ class Window(QWidget):
         for widget in [self.bvid_edit, self.title_label, self.owner_label]:
             layout.addWidget(widget)
         for widgets in [
-            [self.cover_btn, self.download_btn],
+            [self.cover_btn, self.download_btn, self.stream_check],
             [self.video_bar, self.setting_btn],
             [self.audio_bar, self.mix_btn]
         ]:
@@ -587,10 +849,32 @@ class Window(QWidget):
         self.bvid_edit.setEnabled(True)
 
     def download_btn_handler(self):
+        if self.download_thread.isRunning():
+            if not self.download_thread.serving:
+                self.log_text.append('上一个视频还在下载，请等它下载完成后再开始新的下载')
+                return
+            # 上次边下边播的播放服务还开着，要先关掉，关掉后在download_finished_handler里开始下载
+            self.download_btn.setEnabled(False)
+            self.pending_download = True
+            self.download_thread.stop()
+            return
         self.download_btn.setEnabled(False)
         self.download_thread.video = self.video
+        self.download_thread.stream = self.stream_check.isChecked()
         self.download_thread.start()
 
+    def download_finished_handler(self):
+        if self.pending_download:
+            self.pending_download = False
+            self.download_btn_handler()
+        else:  # 下载失败时也要能重新下载
+            self.download_btn.setEnabled(bool(self.data.bvid))
+
+    def closeEvent(self, event):
+        self.download_thread.stop()
+        self.download_thread.wait(int(SHUTDOWN_TIMEOUT * 1000) + 1000)  # 不能无限等，关不掉就算了
+        super().closeEvent(event)
+
     def downloaded_handler(self):
         self.download_btn.setEnabled(True)
 
@@ -653,6 +937,7 @@ class Window(QWidget):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Bilibili video downloader')
     parser.add_argument('-p', '--proxy', type=str, help='Set the proxy for downloading')
+    parser.add_argument('--port', type=int, default=18080, help='Set the local port for watching while downloading')
     args = parser.parse_args()
 
     if args.proxy is not None: